@@ -6,12 +6,76 @@ author: maxime.agez@polymtl.ca
 """
 
 import pandas as pd
+import numpy as np
 import json
-import pkg_resources
-from sentence_transformers import (SentenceTransformer, util)
+import os
+import hashlib
+import functools
+import pickle
+import tempfile
+import torch
+from sentence_transformers import SentenceTransformer
+
+# reference classifications shipped with the module
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+# encoded reference classifications are stored here so that they are only computed once per transformer model. The
+# IE_ML_MAPPING_CACHE_DIR environment variable moves the cache, setting it to an empty string disables it.
+CACHE_DIR = os.environ.get('IE_ML_MAPPING_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'ie_ml_mapping'))
+
+
+@functools.lru_cache(maxsize=None)
+def _load_json(filename):
+    """
+    Reads a JSON file of the Data folder. Results are kept in memory, so each file is only parsed once per session,
+    whatever the amount of Mapping instances. Since the result is shared, it is frozen: lists become tuples.
+    :param filename: [string] the name of the JSON file in the Data folder
+    :return: the content of the file, a [tuple] of strings or of tuples of strings
+    """
+    with open(os.path.join(DATA_DIR, filename), 'r') as f:
+        return tuple(tuple(i) if isinstance(i, list) else i for i in json.load(f))
+
+
+def _quantize(embeddings):
+    """
+    Symmetric per-row int8 quantization of embeddings.
+    :param embeddings: [torch.Tensor] 2-D tensor of embeddings, one row per text
+    :return: the int8 embeddings and the float32 scale of each row, such that embeddings ~ quantized * scale
+    """
+    embeddings = embeddings.float()
+    scale = embeddings.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127
+    return (embeddings / scale).round().clamp(-128, 127).to(torch.int8), scale
 
 
 class Mapping:
+    # reference classification: (file in the Data folder, whether its entries are (code, label) pairs)
+    _DISPATCH = {
+        'IOCC': ('IOCC_sectors.json', False),
+        'openIO-Canada': ('IOCC_sectors.json', False),
+        'NACE Rev.1.1': ('NACE_1_1_sectors.json', True),
+        'NACE Rev.2': ('NACE_2_sectors.json', True),
+        'CPA 2008': ('CPA_2008_sectors.json', True),
+        'CPA 2.1': ('CPA_2_1_sectors.json', True),
+        'exiobase': ('exiobase_sectors.json', False),
+        'USEEIO 2.0': ('USEEIO_sectors.json', False),
+        'GTAP 10': ('GTAP_sectors.json', False),
+        'NAPCS 2017': ('NAPCS_2017_sectors.json', True),
+        'NAPCS 2022': ('NAPCS_2022_sectors.json', True),
+        'NAICS 2017': ('NAICS_2017_sectors.json', True),
+        'NAICS 2022': ('NAICS_2022_sectors.json', True),
+        'ISIC Rev.4': ('ISIC_4_sectors.json', True),
+        'CPC 2.1': ('CPC_2_1_sectors.json', True),
+        'COICOP 2018': ('COICOP_2018_sectors.json', True),
+        'ecoinvent 3.8 technosphere': ('ecoinvent_3_8_sectors.json', False),
+        'ecoinvent 3.9 technosphere': ('ecoinvent_3_9_sectors.json', False),
+        'ecoinvent 3.8 elementary flows': ('ecoinvent_3_8_flows.json', False),
+        'ecoinvent 3.9 elementary flows': ('ecoinvent_3_9_flows.json', False),
+        'IMPACT World+ 2.0': ('IW_2.0_flows.json', False),
+        'USEtox 2': ('USEtox_flows.json', False),
+        'EF 3.0': ('EF_3_0_flows.json', False),
+        'EF 3.1': ('EF_3_1_flows.json', False),
+    }
+
     def __init__(self, reference_classification, transformer_model, number_of_guesses):
         """
         :param reference_classification: [string] The reference classification that is used for matching.
@@ -46,9 +110,18 @@ class Mapping:
         """
 
         self.reference_classification = reference_classification
-        self.model = SentenceTransformer(transformer_model)
+        self.transformer_model = transformer_model
         self.number_of_guesses = number_of_guesses
 
+        # embeddings and similarity scores are kept on the GPU whenever one is available
+        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.model = SentenceTransformer(transformer_model, device=self.device)
+        # half precision is only worth it (and well supported) on GPU
+        if self.device == 'cuda':
+            self.model = self.model.half()
+        self._encode_kwargs = dict(batch_size=128, convert_to_tensor=True, normalize_embeddings=True,
+                                   show_progress_bar=False, device=self.device)
+
         # define attributes
         self.mapping = None
         self.sorted_scores = None
@@ -56,76 +129,34 @@ class Mapping:
         self.inputs = None
         self.input_embeddings = None
         self.reference_embeddings = None
-        self.iocc_sectors = None
-        self.exio_sectors = None
-        self.useeio_sectors = None
-        self.gtap_sectors = None
-        self.nace_1_1_sectors = None
-        self.nace_2_sectors = None
-        self.cpa_2008_sectors = None
-        self.cpa_2_1_sectors = None
-        self.napcs_2017_sectors = None
-        self.napcs_2022_sectors = None
-        self.naics_2017_sectors = None
-        self.naics_2022_sectors = None
-        self.isic_4_sectors = None
-        self.cpc_2_1_sectors = None
-        self.coicop_sectors = None
-        self.ecoinvent_3_8_technosphere = None
-        self.ecoinvent_3_9_technosphere = None
-        self.ecoinvent_3_8_flows = None
-        self.ecoinvent_3_9_flows = None
-        self.iw_flows = None
-        self.usetox_flows = None
-        self.ef_3_0_flows = None
-        self.ef_3_1_flows = None
-
-        if self.reference_classification in ['IOCC', 'openIO-Canada']:
-            self.match_to_iocc()
-        elif self.reference_classification in ['NACE Rev.1.1']:
-            self.match_to_nace_1_1()
-        elif self.reference_classification in ['NACE Rev.2']:
-            self.match_to_nace_2()
-        elif self.reference_classification in ['CPA 2008']:
-            self.match_to_cpa_2008()
-        elif self.reference_classification in ['CPA 2.1']:
-            self.match_to_cpa_2_1()
-        elif self.reference_classification in ['exiobase']:
-            self.match_to_exio()
-        elif self.reference_classification in ['USEEIO 2.0']:
-            self.match_to_useeio()
-        elif self.reference_classification in ['GTAP 10']:
-            self.match_to_gtap()
-        elif self.reference_classification in ['NAPCS 2017']:
-            self.match_to_napcs_2017()
-        elif self.reference_classification in ['NAPCS 2022']:
-            self.match_to_napcs_2022()
-        elif self.reference_classification in ['NAICS 2017']:
-            self.match_to_naics_2017()
-        elif self.reference_classification in ['NAICS 2022']:
-            self.match_to_naics_2022()
-        elif self.reference_classification in ['ISIC Rev.4']:
-            self.match_to_isic_4()
-        elif self.reference_classification in ['CPC 2.1']:
-            self.match_to_cpc_2_1()
-        elif self.reference_classification in ['COICOP 2018']:
-            self.match_to_coicop()
-        elif self.reference_classification in ['ecoinvent 3.8 technosphere']:
-            self.match_to_ei38_techno()
-        elif self.reference_classification in ['ecoinvent 3.9 technosphere']:
-            self.match_to_ei39_techno()
-        elif self.reference_classification in ['ecoinvent 3.8 elementary flows']:
-            self.match_to_ei38_flows()
-        elif self.reference_classification in ['ecoinvent 3.9 elementary flows']:
-            self.match_to_ei39_flows()
-        elif self.reference_classification in ['IMPACT World+ 2.0']:
-            self.match_to_iw()
-        elif self.reference_classification in ['USEtox 2']:
-            self.match_to_usetox()
-        elif self.reference_classification in ['EF 3.0']:
-            self.match_to_ef_3_0()
-        elif self.reference_classification in ['EF 3.1']:
-            self.match_to_ef_3_1()
+        self.reference_list = None
+        self._reference_array = None
+        self._reference_embeddings_q = None
+        self._reference_scale = None
+
+        if self.reference_classification not in self._DISPATCH:
+            raise ValueError('Unknown reference classification: ' + str(self.reference_classification) +
+                             '. Available choices are: ' + ', '.join(self._DISPATCH))
+        filename, is_coded = self._DISPATCH[self.reference_classification]
+        self.reference_list, self.reference_embeddings = self._load_reference(filename, is_coded)
+        # object array of the entries, built once for the fancy indexing of _build_mapping: (number of entries, 2) for
+        # (code, label) pairs, 1-D otherwise (even when the entries are themselves lists)
+        if is_coded:
+            self._reference_array = np.array(self.reference_list, dtype=object)
+        else:
+            self._reference_array = pd.Series(self.reference_list, dtype=object).to_numpy()
+
+        # on GPUs with int8 tensor cores, the similarity matmul reads an int8 copy of the reference embeddings, i.e.
+        # half the bytes of FP16 per product, with negligible impact on the ranking of guesses. The FP16 embeddings are
+        # kept too (for small chunks), so this is a speed-up, not a memory saving
+        if (self.device == 'cuda' and hasattr(torch, '_int_mm') and torch.cuda.get_device_capability() >= (8, 0) and
+                self.reference_embeddings.shape[1] % 8 == 0):
+            reference_q, reference_scale = _quantize(self.reference_embeddings)
+            # torch._int_mm needs the number of references to be a multiple of 8, padded rows are sliced off later
+            padding = -len(reference_q) % 8
+            reference_q = torch.cat([reference_q, reference_q.new_zeros((padding, reference_q.shape[1]))])
+            self._reference_embeddings_q = reference_q.T.contiguous()
+            self._reference_scale = reference_scale.T
 
     def match_inputs(self, inputs):
         """
@@ -134,311 +165,166 @@ class Mapping:
         :return:
         """
         self.inputs = inputs
-        self.input_embeddings = self.model.encode(self.inputs)
-
-    def match_to_iocc(self):
-        """
-        Method maps list of inputs to the Detailed level of the IOCC classification, notably used in the Input-Output
-        database OpenIO-Canada.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/IOCC_sectors.json'), 'r') as f:
-            self.iocc_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode(self.iocc_sectors)
-
-    def match_to_nace_1_1(self):
-        """
-        Method maps list of inputs to the NACE Rev. 1.1 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/NACE_1_1_sectors.json'), 'r') as f:
-            self.nace_1_1_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.nace_1_1_sectors])
-
-    def match_to_nace_2(self):
-        """
-        Method maps list of inputs to the NACE Rev. 2 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/NACE_2_sectors.json'), 'r') as f:
-            self.nace_2_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.nace_2_sectors])
-
-    def match_to_cpa_2008(self):
-        """
-        Method maps list of inputs to the CPA 2008 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/CPA_2008_sectors.json'), 'r') as f:
-            self.cpa_2008_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.cpa_2008_sectors])
-
-    def match_to_cpa_2_1(self):
-        """
-        Method maps list of inputs to the CPA 2.1 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/CPA_2_1_sectors.json'), 'r') as f:
-            self.cpa_2_1_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.cpa_2_1_sectors])
-
-    def match_to_exio(self):
-        """
-        Method maps list of inputs to the exiobase classification, the latter is inspired by NACE.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/exiobase_sectors.json'), 'r') as f:
-            self.exio_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode(self.exio_sectors)
-
-    def match_to_useeio(self):
-        """
-        Method maps list of inputs to the USEEIO 2.0 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/USEEIO_sectors.json'), 'r') as f:
-            self.useeio_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode(self.useeio_sectors)
-
-    def match_to_gtap(self):
-        """
-        Method maps list of inputs to the classification of the GTAP database.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/GTAP_sectors.json'), 'r') as f:
-            self.gtap_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode(self.gtap_sectors)
-
-    def match_to_napcs_2017(self):
-        """
-        Method maps list of inputs to the NAPCS 2017 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/NAPCS_2017_sectors.json'), 'r') as f:
-            self.napcs_2017_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.napcs_2017_sectors])
-
-    def match_to_napcs_2022(self):
-        """
-        Method maps list of inputs to the NAPCS 2022 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/NAPCS_2022_sectors.json'), 'r') as f:
-            self.napcs_2022_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.napcs_2022_sectors])
-
-    def match_to_naics_2017(self):
-        """
-        Method maps list of inputs to the NAICS 2017 classification.
-        :return:
+        self.input_embeddings = self._encode(self.inputs)
+
+    def _encode(self, texts):
+        """
+        Encodes a list of texts with the machine learning model, in large batches, and L2-normalizes the resulting
+        embeddings.
+        :param texts: a [list] of words to-be-encoded
+        :return: a [torch.Tensor] of unit-norm embeddings, one row per text
+        """
+        return self.model.encode(texts, **self._encode_kwargs).to(self.device)
+
+    def _encode_reference(self, texts):
+        """
+        Encodes the texts of the reference classification, reusing the embeddings cached on disk by a previous run
+        with the same classification, transformer model and device. Without a usable cache folder, texts are simply
+        encoded.
+        :param texts: a [list] of the reference classification texts
+        :return: a [torch.Tensor] of unit-norm embeddings, one row per text
+        """
+        if not CACHE_DIR:
+            return self._encode(texts)
+
+        key = hashlib.sha1((self.transformer_model + self.device + json.dumps(texts)).encode()).hexdigest()
+        path = os.path.join(CACHE_DIR, self.reference_classification + '_' + key + '.pt')
+
+        if os.path.exists(path):
+            try:
+                return torch.load(path, map_location=self.device)
+            except (OSError, RuntimeError, EOFError, pickle.UnpicklingError):
+                # unreadable cache file (e.g. truncated), it is re-encoded and overwritten below
+                pass
+
+        embeddings = self._encode(texts)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            # write to a temporary file first, so that an interrupted save never leaves a partial file at path
+            fd, temporary_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+            os.close(fd)
+            try:
+                torch.save(embeddings, temporary_path)
+                os.replace(temporary_path, path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        except (OSError, RuntimeError):
+            # the cache is only a speed-up, an unwritable cache folder must not prevent the mapping
+            pass
+        return embeddings
+
+    def _load_reference(self, filename, project_tuple):
+        """
+        Loads a reference classification from the Data folder and encodes it.
+        :param filename: [string] the name of the JSON file of the classification in the Data folder
+        :param project_tuple: [boolean] whether the entries of the classification are (code, label) pairs, in which
+                              case only the labels are encoded
+        :return: the entries of the classification and their embeddings
+        """
+        # each instance gets its own mutable copy of the shared, frozen content of the file
+        data = [list(i) if isinstance(i, tuple) else i for i in _load_json(filename)]
+        texts = [i[1] for i in data] if project_tuple else data
+        return data, self._encode_reference(texts)
+
+    def classify(self, inputs, chunk_size=1024):
+        """
+        Matches a list of inputs to the reference classification in one go: gives the same mapping as calling
+        match_inputs, calculate_scores and format_results, but inputs are encoded and scored chunk by chunk so that only
+        the embeddings and scores of one chunk are held in memory at a time. self.input_embeddings is therefore reset to
+        None, so call match_inputs again before using calculate_scores afterwards.
+        :param inputs: a [list] of words to-be-matched with the reference classification
+        :param chunk_size: [integer] The amount of inputs encoded and scored at once.
+        :return: self.mapping, the final mapping that the user is after
         """
-        with open(pkg_resources.resource_filename(__name__, '/Data/NAICS_2017_sectors.json'), 'r') as f:
-            self.naics_2017_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.naics_2017_sectors])
 
-    def match_to_naics_2022(self):
-        """
-        Method maps list of inputs to the NAICS 2022 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/NAICS_2022_sectors.json'), 'r') as f:
-            self.naics_2022_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.naics_2022_sectors])
+        self.inputs = inputs
+        # the embeddings of the inputs are never held all at once, any left over from match_inputs are stale
+        self.input_embeddings = None
+        top_scores = np.empty((len(inputs), self.number_of_guesses), dtype=np.float32)
+        top_indices = np.empty((len(inputs), self.number_of_guesses), dtype=np.int64)
 
-    def match_to_isic_4(self):
-        """
-        Method maps list of inputs to the ISIC Rev.4 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/ISIC_4_sectors.json'), 'r') as f:
-            self.isic_4_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.isic_4_sectors])
+        for i in range(0, len(inputs), chunk_size):
+            chunk_scores, chunk_indices = self._score_chunk(self._encode(inputs[i:i + chunk_size]))
+            top_scores[i:i + chunk_size] = chunk_scores.float().cpu().numpy()
+            top_indices[i:i + chunk_size] = chunk_indices.cpu().numpy()
 
-    def match_to_cpc_2_1(self):
-        """
-        Method maps list of inputs to the CPC 2.1 classification.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/CPC_2_1_sectors.json'), 'r') as f:
-            self.cpc_2_1_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.cpc_2_1_sectors])
+        self.sorted_scores = torch.from_numpy(top_scores)
+        self.indices = torch.from_numpy(top_indices)
+        self.mapping = self._build_mapping(top_indices, top_scores)
+        return self.mapping
 
-    def match_to_coicop(self):
+    def calculate_scores(self, chunk_size=2048):
         """
-        Method maps list of inputs to the COICOP classification.
-        :return:
+        Calculates similarity scores.
+        :param chunk_size: [integer] The amount of inputs scored at once. Only a chunk_size x len(reference) matrix of
+                           scores is held in memory at a time.
+        :return: a sorted list of the number_of_guesses best similarity scores and the associated indices
         """
-        with open(pkg_resources.resource_filename(__name__, '/Data/COICOP_2018_sectors.json'), 'r') as f:
-            self.coicop_sectors = json.load(f)
-        self.reference_embeddings = self.model.encode([i[1] for i in self.coicop_sectors])
 
-    def match_to_iw(self):
-        """
-        Method maps list of inputs to the classification used by the IMPACT World+ LCIA methodology.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/IW_2.0_flows.json'), 'r') as f:
-            self.iw_flows = json.load(f)
-        self.reference_embeddings = self.model.encode(self.iw_flows)
+        if self.input_embeddings is None:
+            raise ValueError('No input embeddings to score, call match_inputs first.')
 
-    def match_to_ei38_techno(self):
-        """
-        Method maps list of inputs to the product classification used by the ecoinvent 3.8 database.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/ecoinvent_3_8_sectors.json'), 'r') as f:
-            self.ecoinvent_3_8_technosphere = json.load(f)
-        self.reference_embeddings = self.model.encode(self.ecoinvent_3_8_technosphere)
+        sorted_scores, indices = [], []
+        for i in range(0, len(self.input_embeddings), chunk_size):
+            chunk_scores, chunk_indices = self._score_chunk(self.input_embeddings[i:i + chunk_size])
+            sorted_scores.append(chunk_scores)
+            indices.append(chunk_indices)
+        self.sorted_scores = torch.cat(sorted_scores, dim=0)
+        self.indices = torch.cat(indices, dim=0)
 
-    def match_to_ei39_techno(self):
+    def _score_chunk(self, input_embeddings):
         """
-        Method maps list of inputs to the product classification used by the ecoinvent 3.9 database.
-        :return:
+        Scores a chunk of input embeddings against the reference embeddings.
+        :param input_embeddings: [torch.Tensor] L2-normalized embeddings of the inputs, on self.device
+        :return: the sorted number_of_guesses best similarity scores and the associated indices, for each input
         """
-        with open(pkg_resources.resource_filename(__name__, '/Data/ecoinvent_3_9_sectors.json'), 'r') as f:
-            self.ecoinvent_3_9_technosphere = json.load(f)
-        self.reference_embeddings = self.model.encode(self.ecoinvent_3_9_technosphere)
 
-    def match_to_ei38_flows(self):
-        """
-        Method maps list of inputs to the elementary flow classification used by the ecoinvent 3.8 database.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/ecoinvent_3_8_flows.json'), 'r') as f:
-            self.ecoinvent_3_8_flows = json.load(f)
-        self.reference_embeddings = self.model.encode(self.ecoinvent_3_8_flows)
+        n_references = len(self.reference_embeddings)
 
-    def match_to_ei39_flows(self):
-        """
-        Method maps list of inputs to the elementary flow classification used by the ecoinvent 3.9 database.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/ecoinvent_3_9_flows.json'), 'r') as f:
-            self.ecoinvent_3_9_flows = json.load(f)
-        self.reference_embeddings = self.model.encode(self.ecoinvent_3_9_flows)
+        # both embeddings are L2-normalized and on self.device, so cosine similarity is a plain matrix product that
+        # runs on the GPU when available (in int8 if possible, torch._int_mm needs more than 16 rows though)
+        if self._reference_embeddings_q is not None and len(input_embeddings) > 16:
+            input_q, input_scale = _quantize(input_embeddings)
+            scores = torch._int_mm(input_q, self._reference_embeddings_q)[:, :n_references].float()
+            # rescaled in place, so that no other chunk-sized temporary is allocated
+            scores.mul_(input_scale).mul_(self._reference_scale)
+        else:
+            scores = input_embeddings @ self.reference_embeddings.T
+        return torch.topk(scores, k=self.number_of_guesses, dim=1)
 
-    def match_to_usetox(self):
+    def format_results(self):
         """
-        Method maps list of inputs to the classification used by the USEtox database.
-        :return:
+        Formats the results in a dataframe.
+        :return: self.mapping, the final mapping that the user is after
         """
-        with open(pkg_resources.resource_filename(__name__, '/Data/USEtox_flows.json'), 'r') as f:
-            self.usetox_flows = json.load(f)
-        self.reference_embeddings = self.model.encode(self.usetox_flows)
 
-    def match_to_ef_3_0(self):
-        """
-        Method maps list of inputs to the classification used by the EF 3.0 LCIA method.
-        :return:
-        """
-        with open(pkg_resources.resource_filename(__name__, '/Data/EF_3_0_flows.json'), 'r') as f:
-            self.ef_3_0_flows = json.load(f)
-        self.reference_embeddings = self.model.encode(self.ef_3_0_flows)
+        # move the top guesses to the CPU once, instead of one transfer per element
+        self.mapping = self._build_mapping(self.indices.cpu().numpy(), self.sorted_scores.cpu().numpy())
+        return self.mapping
 
-    def match_to_ef_3_1(self):
+    def _build_mapping(self, top_indices, top_scores):
         """
-        Method maps list of inputs to the classification used by the EF 3.1 LCIA method.
-        :return:
+        Builds the mapping dataframe of self.inputs from their best guesses.
+        :param top_indices: [numpy.ndarray] indices in the reference classification of the best guesses, of shape
+                            (number of inputs, number_of_guesses)
+        :param top_scores: [numpy.ndarray] similarity scores of the best guesses, of the same shape
+        :return: the mapping dataframe
         """
-        with open(pkg_resources.resource_filename(__name__, '/Data/EF_3_1_flows.json'), 'r') as f:
-            self.ef_3_1_flows = json.load(f)
-        self.reference_embeddings = self.model.encode(self.ef_3_1_flows)
 
-    def calculate_scores(self):
-        """
-        Calculates similarity scores.
-        :return: a sorted list of the similarity scores and the associated indices
-        """
+        _, is_coded = self._DISPATCH[self.reference_classification]
 
-        scores = util.pytorch_cos_sim(self.input_embeddings, self.reference_embeddings)
-        self.sorted_scores, self.indices = scores.sort(dim=1, descending=True)
+        # one row per (product, guess), built column-wise from the flattened top guesses
+        top_indices = top_indices.ravel()
+        columns = {'product': np.repeat(np.asarray(self.inputs, dtype=object), self.number_of_guesses),
+                   'order': np.tile(np.arange(1, self.number_of_guesses + 1), len(self.inputs))}
 
-    def format_results(self):
-        """
-        Formats the results in a dataframe.
-        :return: self.mapping, the final mapping that the user is after
-        """
+        if not is_coded:
+            columns['sector'] = self._reference_array[top_indices]
+        else:
+            columns['code sector'] = self._reference_array[top_indices, 0]
+            columns['sector'] = self._reference_array[top_indices, 1]
+        columns['similarity'] = top_scores.ravel().astype(float)
 
-        if self.reference_classification in ['IOCC', 'openIO-Canada']:
-            reference_list = self.iocc_sectors
-        elif self.reference_classification in ['NACE Rev.1.1']:
-            reference_list = self.nace_1_1_sectors
-        elif self.reference_classification in ['NACE Rev.2']:
-            reference_list = self.nace_2_sectors
-        elif self.reference_classification in ['CPA 2008']:
-            reference_list = self.cpa_2008_sectors
-        elif self.reference_classification in ['CPA 2.1']:
-            reference_list = self.cpa_2_1_sectors
-        elif self.reference_classification in ['exiobase']:
-            reference_list = self.exio_sectors
-        elif self.reference_classification in ['USEEIO 2.0']:
-            reference_list = self.useeio_sectors
-        elif self.reference_classification in ['GTAP 10']:
-            reference_list = self.gtap_sectors
-        elif self.reference_classification in ['NAPCS 2017']:
-            reference_list = self.napcs_2017_sectors
-        elif self.reference_classification in ['NAPCS 2022']:
-            reference_list = self.napcs_2022_sectors
-        elif self.reference_classification in ['NAICS 2017']:
-            reference_list = self.naics_2017_sectors
-        elif self.reference_classification in ['NAICS 2022']:
-            reference_list = self.naics_2022_sectors
-        elif self.reference_classification in ['ISIC Rev.4']:
-            reference_list = self.isic_4_sectors
-        elif self.reference_classification in ['CPC 2.1']:
-            reference_list = self.cpc_2_1_sectors
-        elif self.reference_classification in ['COICOP 2018']:
-            reference_list = self.coicop_sectors
-        elif self.reference_classification in ['ecoinvent 3.8 technosphere']:
-            reference_list = self.ecoinvent_3_8_technosphere
-        elif self.reference_classification in ['ecoinvent 3.9 technosphere']:
-            reference_list = self.ecoinvent_3_9_technosphere
-        elif self.reference_classification in ['ecoinvent 3.8 elementary flows']:
-            reference_list = self.ecoinvent_3_8_flows
-        elif self.reference_classification in ['ecoinvent 3.9 elementary flows']:
-            reference_list = self.ecoinvent_3_9_flows
-        elif self.reference_classification in ['IMPACT World+ 2.0']:
-            reference_list = self.iw_flows
-        elif self.reference_classification in ['USEtox 2']:
-            reference_list = self.usetox_flows
-        elif self.reference_classification in ['EF 3.0']:
-            reference_list = self.ef_3_0_flows
-        elif self.reference_classification in ['EF 3.1']:
-            reference_list = self.ef_3_1_flows
-
-        if self.reference_classification in ['IOCC', 'openIO-Canada', 'exiobase', 'USEEIO 2.0', 'GTAP 10',
-                                             'ecoinvent 3.8 elementary flows',  'ecoinvent 3.9 elementary flows',
-                                             'ecoinvent 3.8 technosphere', 'ecoinvent 3.9 technosphere',
-                                             'IMPACT World+ 2.0', 'USEtox 2', 'EF 3.0', 'EF 3.1']:
-
-            self.mapping = pd.DataFrame(None, ['order', 'sector', 'similarity'])
-            for i, product in enumerate(self.inputs):
-                for j in range(0, self.number_of_guesses):
-                    self.mapping = pd.concat([self.mapping,
-                                              pd.DataFrame([product,
-                                                            j + 1,
-                                                            reference_list[self.indices[i][j].cpu().numpy()],
-                                                            self.sorted_scores[i][j].cpu().numpy().tolist()],
-                                                           ['product', 'order', 'sector', 'similarity'])],
-                                             axis=1)
-            self.mapping = self.mapping.T.set_index(['product', 'order'])
-            return self.mapping
-
-        elif self.reference_classification in ['NACE Rev.1.1', 'NACE Rev.2', 'CPA 2008', 'CPA 2.1', 'NAPCS 2017',
-                                               'NAPCS 2022', 'NAICS 2017', 'NAICS 2022', 'ISIC Rev.4', 'CPC 2.1',
-                                               'COICOP 2018']:
-
-            self.mapping = pd.DataFrame(None, ['order', 'sector', 'similarity'])
-            for i, product in enumerate(self.inputs):
-                for j in range(0, self.number_of_guesses):
-                    self.mapping = pd.concat([self.mapping,
-                                              pd.DataFrame([product,
-                                                            j + 1,
-                                                            reference_list[self.indices[i][j].cpu().numpy()][0],
-                                                            reference_list[self.indices[i][j].cpu().numpy()][1],
-                                                            self.sorted_scores[i][j].cpu().numpy().tolist()],
-                                                           ['product', 'order', 'code sector', 'sector', 'similarity'])],
-                                             axis=1)
-            self.mapping = self.mapping.T.set_index(['product', 'order'])
-            self.mapping = self.mapping.T.reindex(['code sector', 'sector', 'similarity']).T
-            return self.mapping
+        # columns are inserted in their display order, so no reordering is needed afterwards
+        return pd.DataFrame(columns).set_index(['product', 'order'])